@@ -0,0 +1,91 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ai_coding_assistant as assistant  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def isolated_config(tmp_path, monkeypatch):
+    """Keep every on-disk store in a temp dir and pin the settings the tests depend on."""
+    Config = assistant.Config
+    monkeypatch.setattr(Config, 'CACHE_FILE', tmp_path / 'cache.db')
+    monkeypatch.setattr(Config, 'HISTORY_FILE', tmp_path / 'history.jsonl')
+    monkeypatch.setattr(Config, 'LEGACY_HISTORY_FILE', tmp_path / 'history.json')
+    monkeypatch.setattr(Config, 'ADHD_MODE', True)
+    monkeypatch.setattr(Config, 'PROMPT_COMPACTION', 'off')
+    monkeypatch.setattr(Config, 'COMPACT_FUZZY', False)
+    return Config
+
+
+class Clock:
+    """Stands in for time.time/time.monotonic so time-based state changes are exact."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(assistant.time, 'time', fake)
+    monkeypatch.setattr(assistant.time, 'monotonic', fake)
+    return fake
+
+
+class FakeProvider(assistant.AIProvider):
+    """Scripted provider: each call returns or raises the next outcome, the last one repeats."""
+
+    def __init__(self, key: str, *outcomes, delay: float = 0.0):
+        super().__init__()
+        self.key = key
+        self.outcomes = list(outcomes) or ["ok"]
+        self.delay = delay
+        self.calls = 0
+
+    def _next(self):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if self.delay:
+            assistant.time.sleep(self.delay)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    def generate(self, prompt: str, system: str = "", **kwargs) -> str:
+        return self._next()
+
+    def generate_stream(self, prompt: str, system: str = "", **kwargs):
+        for token in self._next().split(' '):
+            yield token + ' '
+
+
+@pytest.fixture
+def make_router(monkeypatch):
+    """Build an AIRouter over the given (name, provider) pairs, with discovery switched off."""
+    monkeypatch.setattr(assistant.AIRouter, '_initialize_providers', lambda self: None)
+    monkeypatch.setattr(assistant.Config, 'CACHE_ENABLED', False)
+    monkeypatch.setattr(assistant.Config, 'SEMANTIC_CACHE_ENABLED', False)
+    monkeypatch.setattr(assistant.Config, 'ROUTING_MODE', 'sequential')
+    monkeypatch.setattr(assistant.Config, 'RATE_LIMIT_MAX_WAIT', 0.0)
+    routers = []
+
+    def build(*providers):
+        router = assistant.AIRouter()
+        router.providers = list(providers)
+        router.discovery_done = True
+        routers.append(router)
+        return router
+
+    yield build
+    for router in routers:
+        router.cache.close()
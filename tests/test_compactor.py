@@ -0,0 +1,78 @@
+from ai_coding_assistant import PromptCompactor
+
+LONG = "line {} with quite a lot of extra text here"
+
+
+def compact(text: str, mode: str = 'safe') -> str:
+    return PromptCompactor(mode).compact(text)[0]
+
+
+def test_repeated_log_line_ignores_leading_timestamp():
+    text = "start\n" + "".join(f"12:00:0{i} retrying job 7\n" for i in range(5)) + "done"
+    assert compact(text) == (
+        "start\n"
+        "12:00:00 retrying job 7\n"
+        "[... previous line repeated 4 more times ...]\n"
+        "done"
+    )
+
+
+def test_lines_differing_in_numbers_are_kept_by_default():
+    text = "".join(f"retrying job {i}\n" for i in range(5)) + "done"
+    assert compact(text) == text
+
+
+def test_fuzzy_mode_collapses_lines_differing_in_numbers(monkeypatch):
+    from ai_coding_assistant import Config
+    monkeypatch.setattr(Config, 'COMPACT_FUZZY', True)
+    text = "".join(f"retrying job {i}\n" for i in range(5)) + "done"
+    assert compact(text) == "retrying job 0\n[... previous line repeated 4 more times ...]\ndone"
+
+
+def test_repeated_block_collapses_to_one_copy():
+    text = "Traceback:\n" + "  File a.py line 1\n  in f\n" * 4 + "Error"
+    assert compact(text) == (
+        "Traceback:\n"
+        "  File a.py line 1\n"
+        "  in f\n"
+        "[... previous 2 lines repeated 3 more times ...]\n"
+        "Error"
+    )
+
+
+def test_exact_repeats_inside_a_fence_collapse():
+    line = "    result = compute_something_expensive(arguments)"
+    text = "```python\n" + (line + "\n") * 4 + "```"
+    assert compact(text) == f"```python\n{line}\n[... previous line repeated 3 more times ...]\n```"
+
+
+def test_block_seen_earlier_is_elided():
+    block = "\n".join(LONG.format(i) for i in range(6))
+    assert compact(f"{block}\nmiddle\n{block}") == f"{block}\nmiddle\n[... 6 lines repeated from above ...]"
+
+
+def test_block_inside_a_fence_is_never_elided():
+    block = "\n".join(LONG.format(i) for i in range(6))
+    text = f"{block}\nmiddle\n```\n{block}\n```"
+    assert compact(text) == text
+
+
+def test_trailing_whitespace_and_blank_runs_are_squeezed():
+    assert compact("a   \n\n\n\nb") == "a\n\nb"
+
+
+def test_code_mode_drops_comments_and_docstrings():
+    text = '```python\ndef f():\n    """Doc."""\n    # comment\n    return 1\n```'
+    assert compact(text, 'code') == '```python\ndef f():\n    return 1\n```'
+
+
+def test_never_returns_something_longer():
+    text = "x = 1\n" * 4
+    assert compact(text) == text
+
+
+def test_off_mode_is_a_no_op_and_reports_stats():
+    text = "same line\n" * 10
+    compacted, stats = PromptCompactor('off').compact(text)
+    assert compacted == text
+    assert stats == {'bytes_before': len(text), 'bytes_after': len(text), 'tokens_saved': 0}
@@ -0,0 +1,67 @@
+import pytest
+
+from ai_coding_assistant import PLKEngine, PLKFormatter
+
+CASES = [
+    (
+        "Intro\n## Setup\nTODO: fix it\n```python\n# not a header\nTODO: keep\n```\nNOTE: done",
+        "Intro\n\n## Setup\n\n**TODO:** fix it\n```python\n# not a header\nTODO: keep\n```\n**NOTE:** done",
+    ),
+    ("Text with TODO: inline and FIXME: too\n", "Text with **TODO:** inline and **FIXME:** too\n"),
+    ("~~~\n```\ninside tilde\n~~~\nNOTE: out", "~~~\n```\ninside tilde\n~~~\n**NOTE:** out"),
+    ("````\n```\nstill code\n````\n# Head\n", "````\n```\nstill code\n````\n\n# Head\n\n"),
+    ("  ```js\nx\n  ```\n#nospace\n", "  ```js\nx\n  ```\n#nospace\n"),
+    ("TODO", "TODO"),
+    ("prefix NOT", "prefix NOT"),
+]
+
+
+def feed_in_pieces(text: str, cuts) -> str:
+    formatter = PLKFormatter()
+    out, previous = [], 0
+    for cut in list(cuts) + [len(text)]:
+        out.append(formatter.feed(text[previous:cut]))
+        previous = cut
+    return ''.join(out) + formatter.finish()
+
+
+@pytest.mark.parametrize('text, expected', CASES)
+def test_whole_response(text, expected):
+    assert PLKEngine.format_adhd_friendly(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', CASES)
+def test_every_split_into_three_chunks_matches(text, expected):
+    for first in range(len(text) + 1):
+        for second in range(first, len(text) + 1):
+            assert feed_in_pieces(text, [first, second]) == expected, (first, second)
+
+
+@pytest.mark.parametrize('text, expected', CASES)
+def test_one_character_at_a_time(text, expected):
+    assert feed_in_pieces(text, range(1, len(text))) == expected
+
+
+def test_complete_prose_lines_are_released_at_once():
+    formatter = PLKFormatter()
+    assert formatter.feed("Intro\nmore") == "Intro\nmore"
+
+
+def test_possible_keyword_prefix_is_held_back():
+    formatter = PLKFormatter()
+    assert formatter.feed("see TO") == "see "
+    assert formatter.feed("DO: x") == "**TODO:** x"
+
+
+def test_header_waits_for_its_line_end():
+    formatter = PLKFormatter()
+    assert formatter.feed("## Title") == ""
+    assert formatter.feed("\n") == "\n## Title\n\n"
+
+
+def test_disabled_formatter_passes_text_through(monkeypatch):
+    from ai_coding_assistant import Config
+    monkeypatch.setattr(Config, 'ADHD_MODE', False)
+    formatter = PLKFormatter()
+    assert formatter.feed("## TODO: x") == "## TODO: x"
+    assert formatter.finish() == ""
@@ -0,0 +1,161 @@
+import pytest
+
+from ai_coding_assistant import ProviderHealth
+
+
+@pytest.fixture
+def health(clock, monkeypatch):
+    from ai_coding_assistant import Config
+    monkeypatch.setattr(Config, 'CIRCUIT_FAILURE_THRESHOLD', 3)
+    monkeypatch.setattr(Config, 'CIRCUIT_COOLDOWN', 60.0)
+    return ProviderHealth()
+
+
+def open_circuit(health: ProviderHealth):
+    for _ in range(3):
+        health.record_failure(1.0)
+
+
+def test_circuit_opens_after_threshold_failures(health):
+    health.record_failure(1.0)
+    health.record_failure(1.0)
+    assert health.state == 'closed' and health.available()
+    health.record_failure(1.0)
+    assert health.state == 'open'
+    assert not health.available()
+
+
+def test_success_resets_the_failure_count(health):
+    health.record_failure(1.0)
+    health.record_failure(1.0)
+    health.record_success(1.0)
+    health.record_failure(1.0)
+    assert health.state == 'closed'
+    assert health.consecutive_failures == 1
+
+
+def test_open_circuit_turns_half_open_after_cooldown(health, clock):
+    open_circuit(health)
+    clock.advance(59.9)
+    assert health.state == 'open'
+    clock.advance(0.1)
+    assert health.state == 'half-open'
+    assert health.available()
+
+
+def test_half_open_hands_out_a_single_probe(health, clock):
+    open_circuit(health)
+    clock.advance(60)
+    assert health.claim()
+    assert not health.claim()
+    assert not health.available()
+    assert health.state == 'half-open'
+
+
+def test_available_does_not_take_the_probe(health, clock):
+    open_circuit(health)
+    clock.advance(60)
+    assert health.available()
+    assert health.available()
+    assert health.claim()
+
+
+def test_successful_probe_closes_the_circuit(health, clock):
+    open_circuit(health)
+    clock.advance(60)
+    assert health.claim()
+    health.record_success(0.5)
+    assert health.state == 'closed'
+    assert health.claim() and health.claim()
+
+
+def test_failed_probe_reopens_at_once(health, clock):
+    open_circuit(health)
+    clock.advance(60)
+    assert health.claim()
+    health.record_failure(1.0)
+    assert health.state == 'open'
+    clock.advance(60)
+    assert health.state == 'half-open'
+    assert health.claim()
+
+
+def test_released_probe_can_be_claimed_again(health, clock):
+    open_circuit(health)
+    clock.advance(60)
+    assert health.claim()
+    health.release_probe()
+    assert health.available()
+    assert health.claim()
+
+
+def test_stuck_probe_expires_after_a_cooldown(health, clock):
+    open_circuit(health)
+    clock.advance(60)
+    assert health.claim()
+    clock.advance(59)
+    assert not health.claim()
+    clock.advance(1)
+    assert health.claim()
+
+
+def test_closed_and_open_circuits_always_let_a_claim_through(health):
+    assert health.claim()
+    open_circuit(health)
+    assert health.claim()  # only reached when every provider is open and all are tried anyway
+
+
+def test_error_rate_decays_while_idle(health, clock):
+    from ai_coding_assistant import Config
+    health.record_failure(1.0)
+    rate = health.current_error_rate()
+    clock.advance(Config.HEALTH_ERROR_HALF_LIFE)
+    assert health.current_error_rate() == pytest.approx(rate / 2)
+
+
+def half_open(health: ProviderHealth) -> ProviderHealth:
+    open_circuit(health)
+    health.opened_at -= 60  # the cooldown is over
+    return health
+
+
+def test_throttled_probe_is_released(health, make_router):
+    from ai_coding_assistant import ProviderThrottled
+    from conftest import FakeProvider
+    router = make_router(('🆓 Fake', FakeProvider('fake', ProviderThrottled(5, "HTTP 429"))))
+    probe = half_open(router._health('🆓 Fake'))
+    result = router.generate("hi", max_wait=0)
+    assert result['timings']['🆓 Fake']['status'] == 'throttled'
+    assert probe.claim()
+
+
+def test_throttled_racer_releases_its_probe(health, make_router):
+    from ai_coding_assistant import ProviderThrottled
+    from conftest import FakeProvider
+    router = make_router(('🆓 A', FakeProvider('a', ProviderThrottled(5, "HTTP 429"))),
+                         ('🆓 B', FakeProvider('b', ProviderThrottled(5, "HTTP 429"))))
+    probes = [half_open(router._health(name)) for name in ('🆓 A', '🆓 B')]
+    result = router.generate("hi", race=True, max_wait=0)
+    assert result['throttled']
+    assert all(probe.claim() for probe in probes)
+
+
+def test_async_probe_is_released_when_throttled_or_cancelled(health, make_router):
+    import asyncio
+    from ai_coding_assistant import AsyncAIRouter, ProviderThrottled
+    from conftest import FakeProvider
+    throttled = FakeProvider('throttled', ProviderThrottled(5, "HTTP 429"))
+    slow = FakeProvider('slow', "late", delay=0.2)
+    router = AsyncAIRouter(make_router(('🆓 Throttled', throttled), ('🆓 Slow', slow)))
+    probes = [half_open(router.router._health(name)) for name in ('🆓 Throttled', '🆓 Slow')]
+
+    async def cancel_midway():
+        task = asyncio.ensure_future(router.generate("hi"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_midway())
+    assert throttled.calls == 1 and slow.calls == 1
+    assert all(probe.claim() for probe in probes)
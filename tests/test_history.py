@@ -0,0 +1,65 @@
+import json
+
+from ai_coding_assistant import HistoryLog
+
+
+def write_lines(path, records, tail: bytes = b''):
+    with open(path, 'wb') as f:
+        for record in records:
+            f.write(json.dumps(record).encode('utf-8') + b'\n')
+        f.write(tail)
+
+
+def test_missing_file_loads_empty(tmp_path):
+    assert HistoryLog(tmp_path / 'none.jsonl').load_tail(10) == ([], False)
+
+
+def test_half_written_last_line_is_dropped_and_truncated(tmp_path):
+    path = tmp_path / 'history.jsonl'
+    records = [{'role': 'user', 'content': f"message {i}"} for i in range(3)]
+    write_lines(path, records, b'{"role": "assistant", "cont')
+    complete_size = path.stat().st_size - len(b'{"role": "assistant", "cont')
+
+    assert HistoryLog(path).load_tail(10) == (records, False)
+    assert path.stat().st_size == complete_size
+    assert path.read_bytes().endswith(b'\n')
+
+
+def test_append_after_a_torn_line_starts_clean(tmp_path):
+    path = tmp_path / 'history.jsonl'
+    write_lines(path, [{'n': 1}], b'{"n": 2')
+    log = HistoryLog(path)
+    log.load_tail(10)
+    log.append({'n': 3})
+    assert log.flush(5)
+    assert HistoryLog(path).load_tail(10) == ([{'n': 1}, {'n': 3}], False)
+
+
+def test_only_a_partial_line(tmp_path):
+    path = tmp_path / 'history.jsonl'
+    path.write_bytes(b'{"half": ')
+    assert HistoryLog(path).load_tail(5) == ([], False)
+    assert path.stat().st_size == 0
+
+
+def test_tail_reports_older_records(tmp_path):
+    path = tmp_path / 'history.jsonl'
+    records = [{'n': i} for i in range(10)]
+    write_lines(path, records)
+    assert HistoryLog(path).load_tail(3) == (records[-3:], True)
+    assert HistoryLog(path).load_tail(10) == (records, False)
+
+
+def test_tail_spanning_several_read_blocks(tmp_path):
+    path = tmp_path / 'history.jsonl'
+    records = [{'n': i, 'text': 'x' * 1000} for i in range(200)]  # ~200 KB, several 64 KB blocks
+    write_lines(path, records, b'{"n": 200, "te')
+    tail, older = HistoryLog(path).load_tail(150)
+    assert tail == records[-150:]
+    assert older
+
+
+def test_corrupt_complete_line_is_skipped(tmp_path):
+    path = tmp_path / 'history.jsonl'
+    write_lines(path, [{'n': 1}], b'not json\n{"n": 2}\n')
+    assert HistoryLog(path).load_tail(10) == ([{'n': 1}, {'n': 2}], False)
@@ -0,0 +1,57 @@
+import pytest
+
+from ai_coding_assistant import Config, RateLimiter, TokenBucket
+
+
+def test_full_bucket_has_no_wait():
+    bucket = TokenBucket(60)
+    assert bucket.wait_time(60, bucket.updated) == 0.0
+
+
+def test_refill_is_continuous_at_the_per_minute_rate():
+    bucket = TokenBucket(60)  # one unit per second
+    start = bucket.updated
+    bucket.take(60)
+    assert bucket.wait_time(1, start) == pytest.approx(1.0)
+    assert bucket.wait_time(1, start + 0.5) == pytest.approx(0.5)
+    assert bucket.available == pytest.approx(0.5)
+    assert bucket.wait_time(1, start + 1.0) == 0.0
+
+
+def test_refill_never_exceeds_capacity():
+    bucket = TokenBucket(30)
+    bucket.wait_time(1, bucket.updated + 3600)
+    assert bucket.available == 30
+
+
+def test_overdraft_is_repaid_before_the_next_request():
+    bucket = TokenBucket(60)
+    start = bucket.updated
+    bucket.take(90)  # completion tokens are charged after the fact
+    assert bucket.available == -30
+    assert bucket.wait_time(1, start) == pytest.approx(31.0)
+
+
+def test_oversized_request_waits_for_a_full_bucket_only():
+    bucket = TokenBucket(60)
+    start = bucket.updated
+    bucket.take(60)
+    assert bucket.wait_time(1000, start) == pytest.approx(60.0)
+
+
+def test_limiter_reserves_requests_until_the_bucket_is_empty(clock):
+    limiter = RateLimiter(requests_per_minute=2)
+    assert limiter.try_acquire() == 0.0
+    assert limiter.try_acquire() == 0.0
+    assert limiter.try_acquire() == pytest.approx(30.0)
+    clock.advance(30)
+    assert limiter.try_acquire() == 0.0
+
+
+def test_limiter_honours_retry_after(clock):
+    limiter = RateLimiter()
+    limiter.throttled(retry_after=10)
+    assert 10 <= limiter.wait_time() <= 10 + Config.RATE_LIMIT_BACKOFF_BASE  # plus jitter
+    clock.advance(20)
+    assert limiter.wait_time() == 0.0
+
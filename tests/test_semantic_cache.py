@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+from ai_coding_assistant import Config, SemanticCache  # noqa: E402
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch, clock):
+    monkeypatch.setattr(Config, 'SEMANTIC_CACHE_MAX_ENTRIES', 10)
+    monkeypatch.setattr(Config, 'SEMANTIC_CACHE_THRESHOLD', 0.85)
+    cache = SemanticCache(tmp_path / 'semantic.db')
+    yield cache
+    cache.close()
+
+
+def requests(cache: SemanticCache, namespace: str = 'code') -> list:
+    db = cache._connect()
+    return [row[0] for row in db.execute("SELECT request FROM semantic WHERE namespace = ? ORDER BY id",
+                                         (namespace,))]
+
+
+def test_similar_request_hits_and_unrelated_one_misses(cache):
+    cache.add('code', "write a python function that reverses a string", 'p', "answer")
+    hit = cache.lookup('code', "Please, write a Python function that reverses a string!")
+    assert hit is not None and hit['response'] == "answer"
+    assert cache.lookup('code', "set up a postgres replica with streaming replication") is None
+    assert cache.lookup('debug', "write a python function that reverses a string") is None
+
+
+def test_eviction_with_identical_timestamps_keeps_the_newest(cache):
+    # The clock never moves: every entry ties on last use
+    for i in range(11):
+        cache.add('code', f"request number {i} about topic {i}", 'p', f"answer {i}")
+    assert cache.size() == 9
+    assert requests(cache) == [f"request number {i} about topic {i}" for i in range(2, 11)]
+
+
+def test_eviction_drops_least_recently_used_first(cache, clock):
+    for i in range(10):
+        cache.add('code', f"request number {i} about topic {i}", 'p', f"answer {i}")
+        clock.advance(1)
+    assert cache.lookup('code', "request number 0 about topic 0") is not None  # now the most recent
+    clock.advance(1)
+    cache.add('code', "request number 10 about topic 10", 'p', "answer 10")
+    kept = requests(cache)
+    assert len(kept) == 9
+    assert "request number 0 about topic 0" in kept
+    assert "request number 1 about topic 1" not in kept and "request number 2 about topic 2" not in kept
+
+
+def test_eviction_ties_across_namespaces(cache):
+    added = [(namespace, f"{namespace} request {i} on subject {i}") for i in range(6) for namespace in ('code', 'debug')]
+    for namespace, text in added[:11]:
+        cache.add(namespace, text, 'p', "a")
+    assert cache.size() == 9
+    # The oldest inserts go first, whichever namespace they are in
+    assert requests(cache, 'code') == [text for namespace, text in added[2:11] if namespace == 'code']
+    assert requests(cache, 'debug') == [text for namespace, text in added[2:11] if namespace == 'debug']
+
+
+def test_evicted_rows_are_gone_after_reload(cache, tmp_path):
+    for i in range(11):
+        cache.add('code', f"request number {i} about topic {i}", 'p', f"answer {i}")
+    reloaded = SemanticCache(tmp_path / 'semantic.db')
+    try:
+        reloaded._load()
+        assert reloaded.size() == 9
+    finally:
+        reloaded.close()
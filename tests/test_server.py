@@ -0,0 +1,101 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ai_coding_assistant import AssistantServer, ServerBusy
+
+
+class BlockingRouter:
+    """Holds every call until released, so concurrent requests overlap for sure."""
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def generate(self, prompt, system="", **kwargs):
+        with self._lock:
+            self.calls.append((prompt, kwargs))
+        assert self.release.wait(5)
+        return {'success': True, 'provider': 'fake', 'response': f"answer to {prompt}", 'timings': {}}
+
+
+@pytest.fixture
+def router():
+    return BlockingRouter()
+
+
+@pytest.fixture
+def server(router):
+    server = AssistantServer(router, workers=4, queue_size=4)
+    yield server
+    router.release.set()
+    server.shutdown()
+
+
+def run_together(server, router, requests):
+    with ThreadPoolExecutor(max_workers=len(requests)) as pool:
+        futures = [pool.submit(server.generate, *args, **kwargs) for args, kwargs in requests]
+        wait_for(lambda: server.stats['requests'] == len(requests))
+        router.release.set()
+        return [future.result(5) for future in futures]
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_identical_requests_share_one_upstream_call(server, router):
+    results = run_together(server, router, [(("hello", "sys"), {})] * 3)
+    assert len(router.calls) == 1
+    assert sorted(coalesced for _, coalesced in results) == [False, True, True]
+    assert all(result['response'] == "answer to hello" for result, _ in results)
+    assert server.stats == {'requests': 3, 'rejected': 0, 'coalesced': 2, 'upstream': 1}
+
+
+def test_different_prompts_are_not_merged(server, router):
+    run_together(server, router, [(("a", "sys"), {}), (("b", "sys"), {})])
+    assert sorted(prompt for prompt, _ in router.calls) == ["a", "b"]
+
+
+def test_different_generation_settings_are_not_merged(server, router):
+    run_together(server, router, [(("a", "sys"), {'temperature': 0.1}), (("a", "sys"), {'temperature': 0.9})])
+    assert len(router.calls) == 2
+
+
+def test_different_sessions_are_not_merged(server, router):
+    run_together(server, router, [(("a", "sys", "one"), {}), (("a", "sys", "two"), {})])
+    assert len(router.calls) == 2
+    assert server.stats['coalesced'] == 0
+
+
+def test_finished_flight_is_not_reused(server, router):
+    router.release.set()
+    server.generate("a", "sys")
+    server.generate("a", "sys")
+    assert len(router.calls) == 2
+    assert not server._flights
+
+
+def test_full_queue_rejects_but_still_merges(router):
+    server = AssistantServer(router, workers=1, queue_size=0)
+    try:
+        first = ThreadPoolExecutor(max_workers=2)
+        running = first.submit(server.generate, "a", "sys")
+        wait_for(lambda: server.admitted == 1)
+        with pytest.raises(ServerBusy):
+            server.generate("b", "sys")
+        merged = first.submit(server.generate, "a", "sys")
+        wait_for(lambda: server.stats['coalesced'] == 1)
+        router.release.set()
+        assert running.result(5)[1] is False and merged.result(5)[1] is True
+        assert server.stats['rejected'] == 1
+        first.shutdown()
+    finally:
+        router.release.set()
+        server.shutdown()